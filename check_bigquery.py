@@ -2,13 +2,124 @@
 
 import sys
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='google.api_core._python_version_support')
 
 from google.cloud import bigquery
 from google.cloud import billing_v1
+from google.api_core import retry
 from google.auth import default
+from google.auth.credentials import with_scopes_if_required
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+
+# Upper bound on concurrent metadata requests, kept well under the BigQuery API quota
+METADATA_WORKERS = 16
+LIST_WORKERS = 8
+TABLES_PAGE_SIZE = 1000
+BILLING_PAGE_SIZE = 100
+HTTP_POOL_SIZE = 32
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S %Z'
+
+# Exponential backoff for rate-limited or transient API errors. BigQuery keeps its own
+# predicate (which also covers 403 rateLimitExceeded) with the same backoff schedule.
+BILLING_RETRY = retry.Retry(predicate=retry.if_transient_error, initial=1.0, maximum=30.0, multiplier=2.0, deadline=120.0)
+BIGQUERY_RETRY = bigquery.DEFAULT_RETRY.with_delay(initial=1.0, maximum=30.0, multiplier=2.0).with_deadline(120.0)
+
+def _pooled_session(credentials):
+    """Authorized HTTP session with a connection pool large enough for the worker threads"""
+    # Supplying _http bypasses the client's own scoping, so scope the credentials here;
+    # service-account and impersonated credentials can't mint a token without scopes
+    session = AuthorizedSession(with_scopes_if_required(credentials, bigquery.Client.SCOPE))
+    session.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    return session
+
+def _format_count(value):
+    # Views and external tables report no row or byte counts
+    return f"{value:,}" if value is not None else "n/a"
+
+def _format_megabytes(num_bytes):
+    return f"{num_bytes / 1048576:.2f} MB" if num_bytes is not None else "n/a"
+
+def _fetch_dataset(client, dataset_id):
+    try:
+        return client.get_dataset(dataset_id, retry=BIGQUERY_RETRY), None
+    except Exception as e:
+        return None, e
+
+def _fetch_table(client, table_ref):
+    try:
+        return client.get_table(table_ref, retry=BIGQUERY_RETRY), None
+    except Exception as e:
+        return None, e
+
+def _partition_date(partition_id):
+    """Date of a daily/hourly partition ID (YYYYMMDD or YYYYMMDDHH)"""
+    return datetime.strptime(partition_id[:8], '%Y%m%d').date()
+
+def _usage_date_range(client, table_ref):
+    """Usage date range of an unpartitioned table; MIN/MAX on the raw timestamp avoids per-row DATE()"""
+    query = f"""
+    SELECT 
+        MIN(usage_start_time) as min_time,
+        MAX(usage_start_time) as max_time
+    FROM `{table_ref}`
+    """
+    for row in client.query(query, retry=BIGQUERY_RETRY).result():
+        if row.min_time and row.max_time:
+            return row.min_time.date(), row.max_time.date()
+    return None
+
+def _query_partition_ranges(client, project_id, dataset_ids):
+    partitions = "\n            UNION ALL\n            ".join(
+        f"SELECT table_schema, table_name, partition_id FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.PARTITIONS`"
+        for dataset_id in dataset_ids
+    )
+    query = f"""
+    SELECT
+        table_schema,
+        table_name,
+        MIN(partition_id) as min_partition,
+        MAX(partition_id) as max_partition
+    FROM (
+            {partitions}
+    )
+    WHERE table_name LIKE 'gcp_billing_export%'
+        -- Skip pseudo-partitions (__NULL__, __UNPARTITIONED__, __STREAMING_UNPARTITIONED__)
+        AND NOT STARTS_WITH(partition_id, '__')
+        -- Emptied partitions would otherwise stretch the reported data range
+        AND total_rows > 0
+    GROUP BY table_schema, table_name
+    """
+    result = client.query(query, retry=BIGQUERY_RETRY).result()
+    return {(row.table_schema, row.table_name): (row.min_partition, row.max_partition) for row in result}
+
+def _fetch_partition_ranges(client, project_id, dataset_ids):
+    """Partition ID ranges of billing export tables keyed by (dataset, table), plus errors by dataset"""
+    if not dataset_ids:
+        return {}, {}
+    try:
+        return _query_partition_ranges(client, project_id, dataset_ids), {}
+    except Exception as e:
+        if len(dataset_ids) == 1:
+            return {}, {dataset_ids[0]: e}
+    
+    # Datasets in different locations cannot share a query; fall back to one query per dataset
+    def query_dataset(dataset_id):
+        try:
+            return _query_partition_ranges(client, project_id, [dataset_id]), None
+        except Exception as e:
+            return {}, e
+    
+    ranges, errors = {}, {}
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        for dataset_id, (dataset_ranges, error) in zip(dataset_ids, executor.map(query_dataset, dataset_ids)):
+            ranges.update(dataset_ranges)
+            if error is not None:
+                errors[dataset_id] = error
+    return ranges, errors
 
 def check_authentication():
     print("=" * 70)
@@ -25,133 +136,166 @@ def check_authentication():
         print("\nRun: gcloud auth application-default login")
         sys.exit(1)
 
-def check_billing_accounts(credentials):
-    print("\n" + "=" * 70)
-    print("STEP 2: Billing Accounts Check")
-    print("=" * 70)
+def _list_billing_accounts(credentials):
     try:
         billing_client = billing_v1.CloudBillingClient(credentials=credentials)
-        request = billing_v1.ListBillingAccountsRequest()
-        accounts = list(billing_client.list_billing_accounts(request=request))
-        
-        if not accounts:
-            print("✗ No billing accounts found")
-            print("  You need a billing account to use billing export")
-            return None
-        
-        print(f"✓ Found {len(accounts)} billing account(s):")
-        for i, account in enumerate(accounts, 1):
-            account_id = account.name.split('/')[-1]
-            status = "Open" if account.open else "Closed"
-            print(f"  {i}. {account.display_name}")
-            print(f"     ID: {account_id}")
-            print(f"     Status: {status}")
-            if hasattr(account, 'currency_code'):
-                print(f"     Currency: {account.currency_code}")
-        
-        return accounts
+        request = billing_v1.ListBillingAccountsRequest(page_size=BILLING_PAGE_SIZE)
+        return list(billing_client.list_billing_accounts(request=request, retry=BILLING_RETRY)), None
     except Exception as e:
-        print(f"✗ Failed to list billing accounts: {e}")
+        return None, e
+
+def _list_dataset_ids(client):
+    """List dataset IDs once; doubles as the BigQuery API access probe"""
+    try:
+        return [dataset.dataset_id for dataset in client.list_datasets(retry=BIGQUERY_RETRY)], None
+    except Exception as e:
+        return None, e
+
+def check_billing_accounts(accounts, error=None):
+    print("\n" + "=" * 70)
+    print("STEP 2: Billing Accounts Check")
+    print("=" * 70)
+    if error is not None:
+        print(f"✗ Failed to list billing accounts: {error}")
         print("  Check permissions: need 'billing.accounts.list'")
         return None
+    
+    if not accounts:
+        print("✗ No billing accounts found")
+        print("  You need a billing account to use billing export")
+        return None
+    
+    print(f"✓ Found {len(accounts)} billing account(s):")
+    for i, account in enumerate(accounts, 1):
+        account_id = account.name.split('/')[-1]
+        status = "Open" if account.open else "Closed"
+        print(f"  {i}. {account.display_name}")
+        print(f"     ID: {account_id}")
+        print(f"     Status: {status}")
+        if hasattr(account, 'currency_code'):
+            print(f"     Currency: {account.currency_code}")
+    
+    return accounts
 
-def check_bigquery_api(client, project_id):
+def check_bigquery_api(error, project_id):
     print("\n" + "=" * 70)
     print("STEP 3: BigQuery API Access Check")
     print("=" * 70)
-    try:
-        datasets = list(client.list_datasets(max_results=1))
-        print(f"✓ BigQuery API is enabled and accessible")
-        return True
-    except Exception as e:
-        print(f"✗ BigQuery API error: {e}")
+    if error is not None:
+        print(f"✗ BigQuery API error: {error}")
         print(f"\nTo enable BigQuery API:")
         print(f"  gcloud services enable bigquery.googleapis.com --project={project_id}")
         return False
+    
+    print(f"✓ BigQuery API is enabled and accessible")
+    return True
 
-def check_datasets_and_tables(client, project_id, billing_accounts):
+def check_datasets_and_tables(client, project_id, billing_accounts, dataset_ids):
     print("\n" + "=" * 70)
     print("STEP 4: Datasets and Tables Check")
     print("=" * 70)
     
-    datasets = list(client.list_datasets())
-    
-    if not datasets:
+    if not dataset_ids:
         print("✗ No datasets found in project")
         print(f"\nTo create a billing export dataset:")
         print(f"  ./setup_bigquery_export.py --setup --billing-account YOUR_BILLING_ID --project {project_id}")
         return None, None
     
-    print(f"✓ Found {len(datasets)} dataset(s):")
+    print(f"✓ Found {len(dataset_ids)} dataset(s):")
     
     billing_export_found = False
     billing_tables = []
     
-    for dataset in datasets:
-        print(f"\n  Dataset: {dataset.dataset_id}")
-        
-        try:
-            dataset_ref = client.get_dataset(dataset.dataset_id)
-            print(f"    Location: {dataset_ref.location}")
-            print(f"    Created: {dataset_ref.created.strftime('%Y-%m-%d %H:%M:%S %Z')}")
-        except Exception as e:
-            print(f"    Could not get dataset details: {e}")
+    # Fetch dataset details and list tables for all datasets concurrently, using large
+    # pages to cut round-trips
+    with ThreadPoolExecutor(max_workers=LIST_WORKERS) as executor:
+        dataset_details = executor.map(lambda d: _fetch_dataset(client, d), dataset_ids)
+        tables_by_dataset = list(zip(dataset_ids, executor.map(
+            lambda d: [t.table_id for t in client.list_tables(d, page_size=TABLES_PAGE_SIZE, retry=BIGQUERY_RETRY)], dataset_ids)))
+        dataset_details = dict(zip(dataset_ids, dataset_details))
+    
+    # Fetch table metadata concurrently; results keep submission order
+    refs = [f"{project_id}.{dataset_id}.{table_id}"
+            for dataset_id, tables in tables_by_dataset for table_id in tables]
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        table_details = dict(zip(refs, executor.map(lambda ref: _fetch_table(client, ref), refs)))
+    
+    billing_dataset_ids = [dataset_id for dataset_id, tables in tables_by_dataset
+                           if any('gcp_billing_export' in table_id for table_id in tables)]
+    partition_ranges, range_errors = _fetch_partition_ranges(client, project_id, billing_dataset_ids)
+    
+    for dataset_id, tables in tables_by_dataset:
+        # Buffer each dataset's report and write it with a single call
+        lines = [f"\n  Dataset: {dataset_id}"]
         
-        tables = list(client.list_tables(dataset.dataset_id))
+        dataset_ref, error = dataset_details[dataset_id]
+        if error is None:
+            lines.append(f"    Location: {dataset_ref.location}")
+            lines.append(f"    Created: {dataset_ref.created:{TIMESTAMP_FORMAT}}")
+        else:
+            lines.append(f"    Could not get dataset details: {error}")
         
         if not tables:
-            print(f"    Tables: 0 (empty dataset)")
+            lines.append(f"    Tables: 0 (empty dataset)")
             
-            if dataset.dataset_id in ['billing_export', 'billing_data', 'billing']:
+            if dataset_id in ['billing_export', 'billing_data', 'billing']:
                 billing_export_found = False
-                print(f"\n    ⚠ This looks like a billing dataset but has no tables!")
-                print(f"    Billing export is NOT configured yet.")
+                lines.append(f"\n    ⚠ This looks like a billing dataset but has no tables!")
+                lines.append(f"    Billing export is NOT configured yet.")
         else:
-            print(f"    Tables: {len(tables)}")
-            for table in tables:
-                print(f"      - {table.table_id}")
+            lines.append(f"    Tables: {len(tables)}")
+            for table_id in tables:
+                lines.append(f"      - {table_id}")
+                
+                table_ref, error = table_details[f"{project_id}.{dataset_id}.{table_id}"]
+                if error is not None:
+                    lines.append(f"        Error getting table details: {error}")
+                    continue
                 
                 try:
-                    table_ref = client.get_table(f"{project_id}.{dataset.dataset_id}.{table.table_id}")
-                    created = table_ref.created.strftime('%Y-%m-%d %H:%M:%S %Z')
                     hours_ago = (datetime.now(table_ref.created.tzinfo) - table_ref.created).total_seconds() / 3600
                     
-                    print(f"        Created: {created} ({hours_ago:.1f} hours ago)")
-                    print(f"        Rows: {table_ref.num_rows:,}")
-                    print(f"        Size: {table_ref.num_bytes / 1024 / 1024:.2f} MB")
+                    lines.append(
+                        f"        Created: {table_ref.created:{TIMESTAMP_FORMAT}} ({hours_ago:.1f} hours ago)\n"
+                        f"        Rows: {_format_count(table_ref.num_rows)}\n"
+                        f"        Size: {_format_megabytes(table_ref.num_bytes)}"
+                    )
                     
-                    if 'gcp_billing_export' in table.table_id:
+                    if 'gcp_billing_export' in table_id:
                         billing_export_found = True
                         billing_tables.append({
-                            'dataset': dataset.dataset_id,
-                            'table': table.table_id,
+                            'dataset': dataset_id,
+                            'table': table_id,
                             'created': table_ref.created,
-                            'rows': table_ref.num_rows,
+                            'rows': table_ref.num_rows or 0,
                             'hours_ago': hours_ago
                         })
                         
-                        # Check date range
+                        # Date range from partition metadata, fetched for all billing tables at once;
+                        # unpartitioned tables have no partition metadata and must be scanned
+                        date_range = None
                         try:
-                            query = f"""
-                            SELECT 
-                                MIN(DATE(usage_start_time)) as min_date,
-                                MAX(DATE(usage_start_time)) as max_date,
-                                COUNT(*) as row_count
-                            FROM `{project_id}.{dataset.dataset_id}.{table.table_id}`
-                            """
-                            result = client.query(query).result()
-                            for row in result:
-                                if row.min_date and row.max_date:
-                                    print(f"        Data range: {row.min_date} to {row.max_date}")
-                                    days_of_data = (row.max_date - row.min_date).days + 1
-                                    print(f"        Coverage: {days_of_data} days")
-                                else:
-                                    print(f"        Data range: No data yet")
-                        except Exception as e:
-                            print(f"        Could not check data range: {e}")
+                            if table_ref.time_partitioning is None:
+                                date_range = _usage_date_range(client, f"{project_id}.{dataset_id}.{table_id}")
+                            elif dataset_id in range_errors:
+                                raise range_errors[dataset_id]
+                            elif (dataset_id, table_id) in partition_ranges:
+                                min_partition, max_partition = partition_ranges[(dataset_id, table_id)]
+                                date_range = _partition_date(min_partition), _partition_date(max_partition)
                             
+                            if date_range:
+                                min_date, max_date = date_range
+                                lines.append(f"        Data range: {min_date} to {max_date}")
+                                days_of_data = (max_date - min_date).days + 1
+                                lines.append(f"        Coverage: {days_of_data} days")
+                            else:
+                                lines.append(f"        Data range: No data yet")
+                        except Exception as e:
+                            lines.append(f"        Could not check data range: {e}")
                 except Exception as e:
-                    print(f"        Error getting table details: {e}")
+                    lines.append(f"        Error getting table details: {e}")
+        
+        sys.stdout.write("\n".join(lines) + "\n")
     
     return billing_export_found, billing_tables
 
@@ -166,7 +310,7 @@ def check_billing_export_configuration(billing_export_found, billing_tables, bil
             print(f"\n  Table: {bt['dataset']}.{bt['table']}")
             print(f"  Created: {bt['created'].strftime('%Y-%m-%d %H:%M:%S %Z')}")
             print(f"  Time elapsed: {bt['hours_ago']:.1f} hours ({bt['hours_ago']/24:.1f} days)")
-            print(f"  Rows: {bt['rows']:,}")
+            print(f"  Rows: {_format_count(bt['rows'])}")
             
             if bt['rows'] == 0:
                 if bt['hours_ago'] < 24:
@@ -211,13 +355,13 @@ def provide_recommendations(billing_export_found, billing_tables, project_id):
         print("  3. Run this check script again to verify")
     
     elif billing_tables:
-        table_has_data = any(bt['rows'] > 0 for bt in billing_tables)
+        table_has_data = any((bt['rows'] or 0) > 0 for bt in billing_tables)
         
         if table_has_data:
             print("\n✅ Billing export is fully configured and working!")
             print("\nYou can now query costs with:")
             for bt in billing_tables:
-                if bt['rows'] > 0:
+                if (bt['rows'] or 0) > 0:
                     # Remove the table prefix - handle both standard and resource export formats
                     table_name = bt['table']
                     if 'gcp_billing_export_resource_v1_' in table_name:
@@ -254,14 +398,21 @@ def main():
     
     credentials, project_id = check_authentication()
     
-    billing_accounts = check_billing_accounts(credentials)
+    client = bigquery.Client(credentials=credentials, project=project_id, _http=_pooled_session(credentials))
+    
+    # The billing and BigQuery checks are independent: run their RPCs concurrently,
+    # then report them in order
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        accounts_future = executor.submit(_list_billing_accounts, credentials)
+        datasets_future = executor.submit(_list_dataset_ids, client)
     
-    client = bigquery.Client(credentials=credentials, project=project_id)
+    billing_accounts = check_billing_accounts(*accounts_future.result())
     
-    if not check_bigquery_api(client, project_id):
+    dataset_ids, api_error = datasets_future.result()
+    if not check_bigquery_api(api_error, project_id):
         sys.exit(1)
     
-    billing_export_found, billing_tables = check_datasets_and_tables(client, project_id, billing_accounts)
+    billing_export_found, billing_tables = check_datasets_and_tables(client, project_id, billing_accounts, dataset_ids)
     
     check_billing_export_configuration(billing_export_found, billing_tables, billing_accounts, project_id)
     
@@ -1,33 +1,238 @@
 #!/usr/bin/env python3
 import argparse
+import os
 import sys
 import json
 import csv
+import textwrap
+import hashlib
+import time
 import warnings
-from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from datetime import date, datetime, timedelta
+from typing import Optional, List, Dict, Any, Iterator, Tuple
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='google.api_core._python_version_support')
 
-try:
-    from google.cloud import billing_v1
-    from google.cloud import bigquery
-    from google.auth import default
-    from google.auth.exceptions import DefaultCredentialsError, RefreshError
-    from tabulate import tabulate
-except ImportError as e:
+def _exit_missing_dependency(e: ImportError):
     print(f"Error: Missing required dependency: {e}")
     print("\nPlease install dependencies with:")
     print("  uv pip install -r requirements.txt")
     sys.exit(1)
 
+# The Cloud Billing and BigQuery clients, BigQuery's HTTP transport and tabulate are
+# imported where they are first used, so each command only pays for what it touches
+try:
+    from google.api_core import retry
+    from google.api_core.exceptions import NotFound
+    from google.auth import default
+    from google.auth.exceptions import DefaultCredentialsError, RefreshError
+except ImportError as e:
+    _exit_missing_dependency(e)
+
+EXPORT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'gcp-bill-viewer', 'export_map.json')
+EXPORT_CACHE_TTL = 24 * 60 * 60
+
+# Cost query results for date ranges that ended at least this many days ago are kept
+# on disk; more recent data may still change as late usage and credits are exported
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'gcp-bill-viewer', 'results')
+RESULT_CACHE_SETTLE_DAYS = 5
+
+# Billing export partitions by export time, which can trail usage time; this slack
+# keeps late-exported usage inside the pruned partition range
+PARTITION_SLACK_DAYS = 2
+
+HTTP_POOL_SIZE = 32
+PROJECT_LIST_WORKERS = 16
+# Largest page the Cloud Billing list RPCs accept
+BILLING_PAGE_SIZE = 100
+
+# Exponential backoff for rate-limited or transient API errors
+BILLING_RETRY = retry.Retry(predicate=retry.if_transient_error, initial=1.0, maximum=30.0, multiplier=2.0, deadline=120.0)
+
+DEFAULT_MAX_BYTES = 10 * 10**9
+ON_DEMAND_USD_PER_TIB = 6.25
+MIN_BYTES_BILLED = 10 * 2**20
+# Bytes billed are rounded up per MB and may drift from the dry-run estimate, so an
+# accepted estimate is capped with this much headroom on top
+BYTES_BILLED_HEADROOM = 1.1
+
+TABLE_MAX_ROWS = 10_000
+
+# Lowercase SKU description fragments mapped to model names; more specific fragments
+# must come before the fragments they contain
+SKU_MODEL_PATTERNS = {
+    'gemini 1.5 pro': 'Gemini 1.5 Pro',
+    'gemini 1.5 flash': 'Gemini 1.5 Flash',
+    'gemini pro': 'Gemini Pro',
+    'gemini flash': 'Gemini Flash',
+    'gemini ultra': 'Gemini Ultra',
+    'claude 3.5 sonnet': 'Claude 3.5 Sonnet',
+    'claude 3.5 haiku': 'Claude 3.5 Haiku',
+    'claude 3 opus': 'Claude 3 Opus',
+    'claude 3 sonnet': 'Claude 3 Sonnet',
+    'claude 3 haiku': 'Claude 3 Haiku',
+    'llama': 'Llama',
+}
+
+# How SKU_MODEL_PATTERNS is matched in SQL: 'regex' (single REGEXP_EXTRACT) or 'like'
+SKU_MATCH_MODE = os.environ.get('GCP_BILL_VIEWER_SQL_MODE', 'regex').lower()
+
+def _load_export_cache() -> Dict[str, Dict[str, Any]]:
+    """Load detected export tables from disk, dropping entries older than the TTL"""
+    try:
+        with open(EXPORT_CACHE_PATH) as f:
+            entries = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {key: entry for key, entry in entries.items() if now - entry.get('timestamp', 0) < EXPORT_CACHE_TTL}
+
+def _save_export_cache(entries: Dict[str, Dict[str, Any]]):
+    try:
+        os.makedirs(os.path.dirname(EXPORT_CACHE_PATH), exist_ok=True)
+        with open(EXPORT_CACHE_PATH, 'w') as f:
+            json.dump(entries, f, indent=2)
+    except OSError:
+        pass
+
+def _result_cache_path(query: str, start_date: date, end_date: date, project_filter: str) -> Optional[str]:
+    """Parquet file for this exact query, or None if the date range may still change"""
+    if end_date + timedelta(days=RESULT_CACHE_SETTLE_DAYS) > date.today():
+        return None
+    key = hashlib.sha256(json.dumps([query, start_date.isoformat(), end_date.isoformat(), project_filter]).encode()).hexdigest()
+    return os.path.join(RESULT_CACHE_DIR, f'{key}.parquet')
+
+def _load_cached_result(path: str):
+    try:
+        import pyarrow.parquet as pq
+        return pq.read_table(path)
+    except (ImportError, OSError, ValueError):
+        return None
+
+def _save_cached_result(path: str, results):
+    try:
+        import pyarrow.parquet as pq
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(results, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    except (ImportError, OSError):
+        pass
+
+def _import_billing_v1():
+    try:
+        from google.cloud import billing_v1
+    except ImportError as e:
+        _exit_missing_dependency(e)
+    return billing_v1
+
+def _normalize_sql(sql: str) -> str:
+    """Dedent and drop trailing whitespace and blank lines from generated SQL"""
+    lines = textwrap.dedent(sql).splitlines()
+    return "\n".join(line.rstrip() for line in lines if line.strip())
+
+def _confirm(prompt: str) -> bool:
+    try:
+        return input(prompt).strip().lower() in ('y', 'yes')
+    except EOFError:
+        print()
+        return False
+
+def _render_grid(data: List[Dict[str, Any]]) -> str:
+    """Grid table matching tabulate's 'grid' format: numbers decimal-aligned, text left-aligned"""
+    headers = list(data[0].keys())
+    
+    def is_number(value: Any) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    
+    numeric = [all(is_number(row[key]) for row in data) for key in headers]
+    columns = []
+    for key, is_numeric in zip(headers, numeric):
+        values = [row[key] for row in data]
+        if not is_numeric:
+            columns.append([str(value) for value in values])
+            continue
+        # Mixed int/float columns are floats; floats print in %g style, as tabulate does
+        if all(isinstance(value, int) for value in values):
+            cells = [str(value) for value in values]
+        else:
+            cells = [format(float(value), 'g') for value in values]
+        # Pad the fractional part so decimal points line up once right-justified
+        points = [cell.rfind('.') if '.' in cell else cell.rfind('e') for cell in cells]
+        decimals = [len(cell) - point - 1 if point >= 0 else -1 for cell, point in zip(cells, points)]
+        most = max(decimals)
+        columns.append([cell + ' ' * (most - places) for cell, places in zip(cells, decimals)])
+    # tabulate keeps at least two spaces of room beside each header
+    widths = [max(len(header) + 2, max(len(cell) for cell in column)) for header, column in zip(headers, columns)]
+    
+    def line(fill: str) -> str:
+        return '+' + '+'.join(fill * (width + 2) for width in widths) + '+'
+    
+    def row_line(values: List[str]) -> str:
+        padded = [
+            value.rjust(width) if is_numeric else value.ljust(width)
+            for value, width, is_numeric in zip(values, widths, numeric)
+        ]
+        return '| ' + ' | '.join(padded) + ' |'
+    
+    separator = line('-')
+    lines = [separator, row_line(headers), line('=')]
+    for cells_row in zip(*columns):
+        lines.append(row_line(list(cells_row)))
+        lines.append(separator)
+    return '\n'.join(lines) + '\n'
+
+def _pooled_session(credentials):
+    """Authorized HTTP session that keeps connections alive across BigQuery calls"""
+    from google.auth.credentials import with_scopes_if_required
+    from google.auth.transport.requests import AuthorizedSession
+    from google.cloud import bigquery
+    from requests.adapters import HTTPAdapter
+    # Supplying _http bypasses the client's own scoping, so scope the credentials here;
+    # service-account and impersonated credentials can't mint a token without scopes
+    session = AuthorizedSession(with_scopes_if_required(credentials, bigquery.Client.SCOPE))
+    session.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+    return session
+
 class GCPBillingViewer:
-    def __init__(self):
+    def __init__(self, refresh_export_cache: bool = False, use_result_cache: bool = True):
         self.credentials = None
         self.project_id = None
+        self._export_cache = {} if refresh_export_cache else _load_export_cache()
+        self.use_result_cache = use_result_cache
+        self._tables = {}
         self._authenticate()
-        self.billing_client = billing_v1.CloudBillingClient(credentials=self.credentials)
-        self.bq_client = bigquery.Client(credentials=self.credentials, project=self.project_id)
+
+    @cached_property
+    def billing_client(self):
+        billing_v1 = _import_billing_v1()
+        return billing_v1.CloudBillingClient(credentials=self.credentials)
+
+    @cached_property
+    def bq_client(self):
+        try:
+            from google.cloud import bigquery
+            from google.cloud import bigquery_storage  # noqa: F401 - required for to_arrow()
+        except ImportError as e:
+            _exit_missing_dependency(e)
+        return bigquery.Client(
+            credentials=self.credentials,
+            project=self.project_id,
+            _http=_pooled_session(self.credentials)
+        )
+
+    @cached_property
+    def bqstorage_client(self):
+        """Storage Read API client for Arrow result downloads, shared by every query in the run"""
+        from google.cloud import bigquery_storage
+        return bigquery_storage.BigQueryReadClient(credentials=self.credentials)
+
+    @property
+    def bq_retry(self):
+        """Same backoff as BILLING_RETRY, keeping BigQuery's predicate (which also covers 403 rateLimitExceeded)"""
+        from google.cloud import bigquery
+        return bigquery.DEFAULT_RETRY.with_delay(initial=1.0, maximum=30.0, multiplier=2.0).with_deadline(120.0)
 
     def _authenticate(self):
         try:
@@ -44,59 +249,96 @@ class GCPBillingViewer:
             print(f"Error during authentication: {e}")
             sys.exit(1)
 
-    def list_billing_accounts(self, account_filter: Optional[str] = None) -> List[Dict[str, Any]]:
-        accounts = []
+    def list_billing_accounts(self, account_filter: Optional[str] = None, master_account: Optional[str] = None) -> List[Dict[str, Any]]:
         try:
-            request = billing_v1.ListBillingAccountsRequest()
-            page_result = self.billing_client.list_billing_accounts(request=request)
-            
-            for account in page_result:
-                account_id = account.name.split('/')[-1]
-                if account_filter and account_filter not in account.name:
-                    continue
-                
-                accounts.append({
-                    'id': account_id,
-                    'name': account.name,
-                    'display_name': account.display_name,
-                    'open': account.open,
-                    'currency': account.currency_code if hasattr(account, 'currency_code') else 'N/A'
-                })
+            return list(self._iter_billing_accounts(account_filter, master_account))
         except Exception as e:
             print(f"Error listing billing accounts: {e}")
             sys.exit(1)
-        return accounts
 
-    def list_projects_with_billing(self, billing_account: Optional[str] = None) -> List[Dict[str, Any]]:
+    def _iter_billing_accounts(self, account_filter: Optional[str] = None, master_account: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """Yield billing accounts as the pager fetches them"""
+        billing_v1 = _import_billing_v1()
+        request = billing_v1.ListBillingAccountsRequest(page_size=BILLING_PAGE_SIZE)
+        if master_account:
+            # Subaccounts of a reseller account are filtered server-side
+            if not master_account.startswith('billingAccounts/'):
+                master_account = f'billingAccounts/{master_account}'
+            request.filter = f'master_billing_account={master_account}'
+        page_result = self.billing_client.list_billing_accounts(request=request, retry=BILLING_RETRY)
+        
+        for account in page_result:
+            account_id = account.name.split('/')[-1]
+            if account_filter and account_filter not in account.name:
+                continue
+            
+            yield {
+                'id': account_id,
+                'name': account.name,
+                'display_name': account.display_name,
+                'open': account.open,
+                'currency': account.currency_code if hasattr(account, 'currency_code') else 'N/A'
+            }
+
+    def list_projects_with_billing(self, billing_account: Optional[str] = None, master_account: Optional[str] = None) -> List[Dict[str, Any]]:
         projects = []
         try:
             if billing_account:
                 if not billing_account.startswith('billingAccounts/'):
                     billing_account = f'billingAccounts/{billing_account}'
-                request = billing_v1.ListProjectBillingInfoRequest(name=billing_account)
-                page_result = self.billing_client.list_project_billing_info(request=request)
-                for project_billing_info in page_result:
-                    projects.append({
-                        'project_id': project_billing_info.project_id,
-                        'billing_account': project_billing_info.billing_account_name.split('/')[-1] if project_billing_info.billing_account_name else 'None',
-                        'billing_enabled': project_billing_info.billing_enabled
-                    })
+                projects = self._list_projects_for_account(billing_account)
             else:
-                accounts = self.list_billing_accounts()
-                for account in accounts:
-                    request = billing_v1.ListProjectBillingInfoRequest(name=account['name'])
-                    page_result = self.billing_client.list_project_billing_info(request=request)
-                    for project_billing_info in page_result:
-                        projects.append({
-                            'project_id': project_billing_info.project_id,
-                            'billing_account': account['id'],
-                            'billing_enabled': project_billing_info.billing_enabled
-                        })
+                # One paged RPC per account; fan them out instead of paying N round trips in a row,
+                # submitting each account as soon as the accounts pager yields it
+                with ThreadPoolExecutor(max_workers=PROJECT_LIST_WORKERS) as executor:
+                    for account_projects in executor.map(
+                            lambda account: self._list_projects_for_account(account['name'], account['id']),
+                            self._iter_billing_accounts(master_account=master_account)):
+                        projects.extend(account_projects)
         except Exception as e:
             print(f"Error listing projects: {e}")
         return projects
 
+    def _list_projects_for_account(self, account_name: str, account_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        billing_v1 = _import_billing_v1()
+        request = billing_v1.ListProjectBillingInfoRequest(name=account_name, page_size=BILLING_PAGE_SIZE)
+        page_result = self.billing_client.list_project_billing_info(request=request, retry=BILLING_RETRY)
+        projects = []
+        for project_billing_info in page_result:
+            if account_id:
+                project_account = account_id
+            else:
+                project_account = project_billing_info.billing_account_name.split('/')[-1] if project_billing_info.billing_account_name else 'None'
+            projects.append({
+                'project_id': project_billing_info.project_id,
+                'billing_account': project_account,
+                'billing_enabled': project_billing_info.billing_enabled
+            })
+        return projects
+
     def detect_bigquery_export(self, billing_account_id: str, verbose: bool = False) -> Optional[str]:
+        cache_key = f'{self.project_id}:{billing_account_id}'
+        cached = self._export_cache.get(cache_key)
+        if cached:
+            # One metadata lookup confirms the cached table still exists
+            try:
+                self._get_table(cached['table_id'])
+                if verbose: print(f"Debug: Using cached export table {cached['table_id']}")
+                return cached['table_id']
+            except NotFound:
+                if verbose: print(f"Debug: Cached export table {cached['table_id']} no longer exists")
+                del self._export_cache[cache_key]
+            except Exception as e:
+                if verbose: print(f"Debug: Could not confirm cached export table: {e}")
+                return cached['table_id']
+        
+        table_id = self._scan_for_bigquery_export(billing_account_id, verbose)
+        if table_id:
+            self._export_cache[cache_key] = {'table_id': table_id, 'timestamp': time.time()}
+            _save_export_cache(self._export_cache)
+        return table_id
+
+    def _scan_for_bigquery_export(self, billing_account_id: str, verbose: bool = False) -> Optional[str]:
         clean_id = billing_account_id.replace('-', '_')
         common_patterns = [
             f'gcp_billing_export_v1_{clean_id}',
@@ -104,30 +346,74 @@ class GCPBillingViewer:
         ]
         common_datasets = ['billing_export', 'billing_data', 'billing']
         
+        # Export table names are fully determined by the account ID, so try the
+        # usual locations with direct metadata lookups before listing anything
+        for dataset_id in common_datasets:
+            for pattern in common_patterns:
+                table_id = f'{self.project_id}.{dataset_id}.{pattern}'
+                try:
+                    self._get_table(table_id)
+                    return table_id
+                except NotFound:
+                    continue
+                except Exception as e:
+                    if verbose: print(f"Debug: Error looking up {table_id}: {e}")
+        
         try:
-            datasets = list(self.bq_client.list_datasets())
-            for dataset in datasets:
-                if dataset.dataset_id in common_datasets:
-                    tables = list(self.bq_client.list_tables(dataset.dataset_id))
-                    for table in tables:
-                        for pattern in common_patterns:
-                            if pattern in table.table_id:
-                                return f'{self.project_id}.{dataset.dataset_id}.{table.table_id}'
+            # Single pass over all datasets: common billing dataset names are checked as soon
+            # as the pager yields them, other dataset IDs are deferred until the pager is drained
+            deferred_ids = []
+            for dataset in self.bq_client.list_datasets(retry=self.bq_retry):
+                if dataset.dataset_id not in common_datasets:
+                    deferred_ids.append(dataset.dataset_id)
+                    continue
+                table_id = self._find_export_table(dataset.dataset_id, common_patterns)
+                if table_id:
+                    return table_id
             
-            # Fallback deep search
-            for dataset in datasets:
-                tables = list(self.bq_client.list_tables(dataset.dataset_id))
-                for table in tables:
-                    for pattern in common_patterns:
-                        if pattern in table.table_id:
-                            return f'{self.project_id}.{dataset.dataset_id}.{table.table_id}'
+            for dataset_id in deferred_ids:
+                table_id = self._find_export_table(dataset_id, common_patterns)
+                if table_id:
+                    return table_id
         except Exception as e:
             if verbose: print(f"Debug: Error during detection: {e}")
             pass
         return None
 
-    def _get_category_sql(self, group_by: str) -> str:
-        """Generate SQL for smart categorization without joining UNNEST(labels)"""
+    def _find_export_table(self, dataset_id: str, patterns: List[str]) -> Optional[str]:
+        for table in self.bq_client.list_tables(dataset_id, retry=self.bq_retry):
+            if any(pattern in table.table_id for pattern in patterns):
+                return f'{self.project_id}.{dataset_id}.{table.table_id}'
+        return None
+
+    def _get_table(self, table_id: str):
+        """Table metadata, fetched at most once per run"""
+        if table_id not in self._tables:
+            self._tables[table_id] = self.bq_client.get_table(table_id, retry=self.bq_retry)
+        return self._tables[table_id]
+
+    def _get_partition_column(self, table_id: str) -> Optional[str]:
+        """Column the table is time-partitioned on, if any"""
+        try:
+            partitioning = self._get_table(table_id).time_partitioning
+        except Exception:
+            return None
+        if partitioning is None:
+            return None
+        return partitioning.field or '_PARTITIONTIME'
+
+    def _get_partition_filter_sql(self, table_id: str) -> str:
+        """Partition pruning predicate matching the table's partitioning scheme"""
+        column = self._get_partition_column(table_id)
+        # Ingestion-time (standard export) and export_time (resource export) partitions
+        # trail usage, so only a lower bound with slack is safe; usage_start_time
+        # partitions are already pruned by the usage filter itself
+        if column in ('_PARTITIONTIME', 'export_time'):
+            return f"AND {column} >= TIMESTAMP_SUB(@start, INTERVAL {PARTITION_SLACK_DAYS} DAY)"
+        return ""
+
+    def _get_model_columns_sql(self) -> str:
+        """Generate SQL for the model columns computed once per row in the base CTE"""
         
         # Logic to extract Model ID from System Labels (Standard for Vertex AI)
         system_label_model_extraction = """
@@ -135,124 +421,313 @@ class GCPBillingViewer:
         """
 
         # Logic to extract Model Name from SKU Description (Fallback if system label missing)
-        sku_model_extraction = """
+        if SKU_MATCH_MODE == 'like':
+            sku_model_extraction = self._get_sku_model_sql_like()
+        else:
+            sku_model_extraction = self._get_sku_model_sql_regex()
+
+        return f"""
+                {system_label_model_extraction} AS model_system,
+                {sku_model_extraction} AS model_sku"""
+
+    def _get_sku_model_sql_regex(self) -> str:
+        """One regex match on the lowercased SKU description, mapped to a model label"""
+        sku_pattern = '|'.join(pattern.replace('.', r'\.') for pattern in SKU_MODEL_PATTERNS)
+        sku_labels = '\n'.join(
+            f"                WHEN '{pattern}' THEN '{label}'" for pattern, label in SKU_MODEL_PATTERNS.items()
+        )
+        return f"""
+            CASE REGEXP_EXTRACT(LOWER(sku.description), r'({sku_pattern})')
+{sku_labels}
+                ELSE NULL
+            END
+        """
+
+    def _get_sku_model_sql_like(self) -> str:
+        """One LIKE predicate per SKU fragment, checked in dictionary order"""
+        sku_labels = '\n'.join(
+            f"                WHEN LOWER(sku.description) LIKE '%{pattern}%' THEN '{label}'"
+            for pattern, label in SKU_MODEL_PATTERNS.items()
+        )
+        return f"""
             CASE
-                WHEN LOWER(sku.description) LIKE '%gemini 1.5 pro%' THEN 'Gemini 1.5 Pro'
-                WHEN LOWER(sku.description) LIKE '%gemini 1.5 flash%' THEN 'Gemini 1.5 Flash'
-                WHEN LOWER(sku.description) LIKE '%gemini pro%' THEN 'Gemini Pro'
-                WHEN LOWER(sku.description) LIKE '%gemini flash%' THEN 'Gemini Flash'
-                WHEN LOWER(sku.description) LIKE '%gemini ultra%' THEN 'Gemini Ultra'
-                WHEN LOWER(sku.description) LIKE '%claude 3.5 sonnet%' THEN 'Claude 3.5 Sonnet'
-                WHEN LOWER(sku.description) LIKE '%claude 3.5 haiku%' THEN 'Claude 3.5 Haiku'
-                WHEN LOWER(sku.description) LIKE '%claude 3 opus%' THEN 'Claude 3 Opus'
-                WHEN LOWER(sku.description) LIKE '%claude 3 sonnet%' THEN 'Claude 3 Sonnet'
-                WHEN LOWER(sku.description) LIKE '%claude 3 haiku%' THEN 'Claude 3 Haiku'
-                WHEN LOWER(sku.description) LIKE '%llama%' THEN 'Llama'
+{sku_labels}
                 ELSE NULL
             END
         """
 
+    def _get_category_sql(self, group_by: str) -> str:
+        """Generate SQL for smart categorization over the columns of the base CTE"""
         if group_by == 'model':
-            return f"""
+            return """
             COALESCE(
                 -- 1. Try System Label (Most Accurate for Vertex)
-                {system_label_model_extraction},
+                model_system,
                 
                 -- 2. Try SKU Description Parsing
-                {sku_model_extraction},
+                model_sku,
                 
                 -- 3. Fallback: If it's Vertex AI but unknown model, show SKU
                 CASE 
-                    WHEN LOWER(service.description) LIKE '%vertex ai%' THEN CONCAT('Vertex AI - ', sku.description)
+                    WHEN LOWER(service_desc) LIKE '%vertex ai%' THEN CONCAT('Vertex AI - ', sku_desc)
                     -- 4. General Fallback for non-AI services
-                    ELSE service.description
+                    ELSE service_desc
                 END
             )
             """
         elif group_by == 'ai':
-            return f"""
+            return """
             CASE 
-                WHEN {system_label_model_extraction} IS NOT NULL OR {sku_model_extraction} IS NOT NULL OR LOWER(service.description) LIKE '%vertex ai%' THEN 'AI/ML Services'
+                WHEN model_system IS NOT NULL OR model_sku IS NOT NULL OR LOWER(service_desc) LIKE '%vertex ai%' THEN 'AI/ML Services'
                 ELSE 'Infrastructure & Other'
             END
             """
         elif group_by == 'project':
-            return "project.name"
+            return "project_name"
         else:
-            return "service.description"
+            return "service_desc"
 
     def get_costs_from_bigquery(
         self,
         billing_account_id: str,
-        start_date: str,
-        end_date: str,
+        start_date: date,
+        end_date: date,
         project_filter: Optional[str] = None,
         group_by: str = 'service',
-        verbose: bool = False
-    ) -> List[Dict[str, Any]]:
+        verbose: bool = False,
+        max_bytes: int = DEFAULT_MAX_BYTES
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Return (costs per category, totals per currency)"""
         
         table_id = self.detect_bigquery_export(billing_account_id, verbose=verbose)
         if not table_id:
             print(f"\nBigQuery billing export not found for account: {billing_account_id}")
-            return []
+            return [], []
         
         print(f"Using BigQuery table: {table_id}")
         
         # Dynamic SQL Generation
         category_expr = self._get_category_sql(group_by)
         
+        partition_filter = self._get_partition_filter_sql(table_id)
+        
+        # Per-row extraction happens once in the base CTE; the outer query only aggregates,
+        # with a second grouping set producing the grand total for each currency
         query = f"""
+        WITH base AS (
+            SELECT
+                cost,
+                currency,
+                project.name AS project_name,
+                service.description AS service_desc,
+                sku.description AS sku_desc,{self._get_model_columns_sql()}
+            FROM `{table_id}`
+            WHERE usage_start_time >= @start
+                AND usage_start_time < @end
+                AND (@project_filter = '' OR project.id = @project_filter)
+                {partition_filter}
+        ),
+        categorized AS (
+            SELECT {category_expr} AS category, cost, currency
+            FROM base
+        )
         SELECT
-            {category_expr} as category,
-            ROUND(SUM(cost), 2) as total_cost,
-            currency
-        FROM `{table_id}`
-        WHERE usage_start_time >= TIMESTAMP('{start_date}')
-            AND usage_start_time < TIMESTAMP('{end_date}')
-        """
-        
-        if project_filter:
-            query += f" AND project.id = '{project_filter}'"
-            
-        query += """
-        GROUP BY category, currency
+            category,
+            SUM(cost) as total_cost,
+            currency,
+            GROUPING(category) AS is_total
+        FROM categorized
+        GROUP BY GROUPING SETS ((category, currency), (currency))
         ORDER BY total_cost DESC
         """
+        # Stable text for identical requests, so BigQuery's result cache can match it
+        query = _normalize_sql(query)
         
         if verbose:
             print("\nGenerated Query:")
             print(query)
+            print(f"Parameters: start={start_date}, end={end_date}, project_filter={project_filter or ''}")
 
+        from google.cloud import bigquery
+        
         try:
-            query_job = self.bq_client.query(query)
-            results = query_job.result()
+            query_parameters = [
+                bigquery.ScalarQueryParameter('start', 'TIMESTAMP', start_date.isoformat()),
+                bigquery.ScalarQueryParameter('end', 'TIMESTAMP', end_date.isoformat()),
+                bigquery.ScalarQueryParameter('project_filter', 'STRING', project_filter or ''),
+            ]
+            
+            cache_path = None
+            if self.use_result_cache:
+                cache_path = _result_cache_path(query, start_date, end_date, project_filter or '')
+            results = _load_cached_result(cache_path) if cache_path else None
+            from_cache = results is not None
+            if from_cache:
+                if verbose: print(f"Debug: Using cached result {cache_path}")
+            else:
+                # Dry runs are free: estimate the scan before paying for it
+                dry_run_job = self.bq_client.query(query, job_config=bigquery.QueryJobConfig(
+                    query_parameters=query_parameters, dry_run=True, use_query_cache=False
+                ), retry=self.bq_retry)
+                bytes_estimate = dry_run_job.total_bytes_processed or 0
+                if verbose:
+                    print(f"Debug: Dry run estimates {bytes_estimate / 1e9:.2f} GB scanned "
+                          f"(~${bytes_estimate / 2**40 * ON_DEMAND_USD_PER_TIB:.2f}, limit {max_bytes / 1e9:.2f} GB)")
+                if bytes_estimate > max_bytes:
+                    print(f"Will scan {bytes_estimate / 1e9:.2f} GB (~${bytes_estimate / 2**40 * ON_DEMAND_USD_PER_TIB:.2f})")
+                    if not _confirm("Run the query anyway? [y/N] "):
+                        print("Query cancelled.")
+                        return [], []
+                
+                # Cap billing at what the user accepted; BigQuery bills at least 10 MB per query
+                accepted_bytes = -(-int(bytes_estimate * BYTES_BILLED_HEADROOM) // 2**20) * 2**20
+                job_config = bigquery.QueryJobConfig(
+                    query_parameters=query_parameters,
+                    use_query_cache=True,
+                    maximum_bytes_billed=max(max_bytes, accepted_bytes, MIN_BYTES_BILLED),
+                    labels={'tool': 'gcp-bill-viewer', 'group_by': group_by}
+                )
+                query_job = self.bq_client.query(query, job_config=job_config, retry=self.bq_retry)
+                results = query_job.result().to_arrow(bqstorage_client=self.bqstorage_client)
             
             costs = []
-            for row in results:
+            totals = []
+            for category, total_cost, currency, is_total in zip(
+                results['category'].to_pylist(),
+                results['total_cost'].to_pylist(),
+                results['currency'].to_pylist(),
+                results['is_total'].to_pylist()
+            ):
+                if is_total:
+                    totals.append({'cost': round(float(total_cost), 2), 'currency': currency})
+                    continue
                 costs.append({
-                    group_by: row.category or 'Unknown',
-                    'cost': float(row.total_cost),
-                    'currency': row.currency
+                    group_by: category or 'Unknown',
+                    'cost': round(float(total_cost), 2),
+                    'currency': currency
                 })
-            return costs
+            
+            # The grand-total row is always returned, so emptiness is judged on the categories;
+            # empty results aren't cached, as the export may still be backfilling the range
+            if costs and cache_path and not from_cache:
+                _save_cached_result(cache_path, results)
+            if not costs:
+                self._diagnose_empty_result(table_id, start_date, end_date, verbose, max_bytes)
+            return costs, totals
         except Exception as e:
             print(f"Error querying BigQuery: {e}")
-            return []
+            return [], []
+
+    def _diagnose_empty_result(self, table_id: str, start_date: date, end_date: date, verbose: bool = False,
+                               max_bytes: int = DEFAULT_MAX_BYTES):
+        """Explain an empty cost result: export not populated yet, or dates outside the available data"""
+        try:
+            table = self._get_table(table_id)
+        except Exception as e:
+            if verbose: print(f"Debug: Could not inspect export table: {e}")
+            return
+        
+        hours_ago = (datetime.now(table.created.tzinfo) - table.created).total_seconds() / 3600
+        if verbose: print(f"Debug: Table created {table.created:%Y-%m-%d %H:%M:%S %Z} ({hours_ago:.1f} hours ago)")
+        
+        # Row count comes from table metadata (rows still in the streaming buffer are not
+        # counted there); only a table with data needs the date coverage query
+        if not table.num_rows and table.streaming_buffer is None:
+            print(f"\nThe billing export table has no data yet (created {hours_ago:.1f} hours ago).")
+            if hours_ago < 24:
+                print(f"Data usually appears within 24 hours; expect it in ~{24 - hours_ago:.1f} hours.")
+            else:
+                print("Still empty after 24+ hours: verify billing export is enabled in the GCP Console.")
+            return
+        
+        from google.cloud import bigquery
+        
+        if table.time_partitioning is not None:
+            # Partition metadata gives the date range without scanning the table; pseudo-partitions
+            # such as __NULL__ or __STREAMING_UNPARTITIONED__ don't parse as dates and drop out
+            probe = f"""
+            SELECT
+                MIN(SAFE.PARSE_DATE('%Y%m%d', SUBSTR(partition_id, 1, 8))) AS min_date,
+                MAX(SAFE.PARSE_DATE('%Y%m%d', SUBSTR(partition_id, 1, 8))) AS max_date
+            FROM `{table.project}.{table.dataset_id}.INFORMATION_SCHEMA.PARTITIONS`
+            WHERE table_name = @table_name AND total_rows > 0
+            """
+            query_parameters = [bigquery.ScalarQueryParameter('table_name', 'STRING', table.table_id)]
+        else:
+            probe = f"""
+            SELECT
+                MIN(DATE(usage_start_time)) AS min_date,
+                MAX(DATE(usage_start_time)) AS max_date
+            FROM `{table_id}`
+            """
+            query_parameters = []
+        
+        try:
+            # An unpartitioned table has to be scanned, so it is held to the same --max-bytes limit
+            if table.time_partitioning is None:
+                dry_run_job = self.bq_client.query(probe, job_config=bigquery.QueryJobConfig(
+                    dry_run=True, use_query_cache=False
+                ), retry=self.bq_retry)
+                if (dry_run_job.total_bytes_processed or 0) > max_bytes:
+                    if verbose: print("Debug: Skipping data range check, it would scan more than --max-bytes")
+                    return
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=query_parameters,
+                maximum_bytes_billed=max(max_bytes, MIN_BYTES_BILLED)
+            )
+            probe_row = next(iter(self.bq_client.query(probe, job_config=job_config, retry=self.bq_retry).result()))
+        except Exception as e:
+            if verbose: print(f"Debug: Could not check data range: {e}")
+            return
+        
+        if probe_row.min_date is None:
+            print(f"\nNo usage recorded between {start_date} and {end_date}.")
+        elif probe_row.max_date < start_date or probe_row.min_date >= end_date:
+            print(f"\nRequested range {start_date} to {end_date} does not overlap the available data "
+                  f"({probe_row.min_date} to {probe_row.max_date}).")
+        else:
+            print(f"\nNo usage recorded between {start_date} and {end_date}.")
 
     def format_output(self, data: List[Dict[str, Any]], output_format: str):
         if not data:
             print("No data to display.")
             return
         
+        # Tables are buffered whole to size columns; stream very large results as CSV
+        if output_format in ('table', 'pretty') and len(data) >= TABLE_MAX_ROWS:
+            output_format = 'csv'
+        
         if output_format == 'json':
-            print(json.dumps(data, indent=2))
+            try:
+                import orjson  # optional, much faster for large results
+            except ImportError:
+                orjson = None
+            if orjson is not None:
+                sys.stdout.flush()
+                sys.stdout.buffer.write(orjson.dumps(data, option=orjson.OPT_INDENT_2) + b"\n")
+                sys.stdout.buffer.flush()
+            else:
+                json.dump(data, sys.stdout, indent=2)
+                sys.stdout.write("\n")
         elif output_format == 'csv':
-            if data:
-                writer = csv.DictWriter(sys.stdout, fieldnames=data[0].keys())
-                writer.writeheader()
-                writer.writerows(data)
-        else:
+            keys = list(data[0])
+            writer = csv.writer(sys.stdout)
+            writer.writerow(keys)
+            writer.writerows([row[key] for key in keys] for row in data)
+        elif output_format == 'pretty':
+            try:
+                from tabulate import tabulate
+            except ImportError as e:
+                _exit_missing_dependency(e)
             print(tabulate(data, headers='keys', tablefmt='grid'))
+        else:
+            sys.stdout.write(_render_grid(data))
+
+def _parse_date(value: str) -> date:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date '{value}', expected YYYY-MM-DD")
 
 def main():
     parser = argparse.ArgumentParser(description='GCP Billing Viewer')
@@ -260,11 +735,18 @@ def main():
     parser.add_argument('--list-projects', action='store_true', help='List projects')
     parser.add_argument('--costs', action='store_true', help='Get costs')
     parser.add_argument('--billing-account', type=str, help='Billing Account ID')
+    parser.add_argument('--master-billing-account', type=str,
+                        help='Only list subaccounts of this master billing account (filtered server-side)')
     parser.add_argument('--project', type=str, help='Project ID filter')
-    parser.add_argument('--start-date', type=str, help='YYYY-MM-DD')
-    parser.add_argument('--end-date', type=str, help='YYYY-MM-DD')
+    parser.add_argument('--start-date', type=_parse_date, help='YYYY-MM-DD')
+    parser.add_argument('--end-date', type=_parse_date, help='YYYY-MM-DD')
     parser.add_argument('--group-by', type=str, choices=['service', 'project', 'ai', 'model'], default='service')
-    parser.add_argument('--format', type=str, choices=['table', 'csv', 'json'], default='table')
+    parser.add_argument('--format', type=str, choices=['table', 'pretty', 'csv', 'json'], default='table',
+                        help='Output format; pretty renders the table with tabulate')
+    parser.add_argument('--max-bytes', type=int, default=DEFAULT_MAX_BYTES,
+                        help='Ask for confirmation before cost queries that scan more bytes than this (default: 10 GB)')
+    parser.add_argument('--refresh-export-cache', action='store_true', help='Re-detect the BigQuery export table instead of using the cached one')
+    parser.add_argument('--no-result-cache', action='store_true', help='Always query BigQuery instead of reusing cached results for past date ranges')
     parser.add_argument('--debug', action='store_true', help='Debug mode')
     
     args = parser.parse_args()
@@ -273,30 +755,32 @@ def main():
         parser.print_help()
         sys.exit(0)
     
-    viewer = GCPBillingViewer()
+    # Validate before authenticating, so a bad invocation fails without touching the network
+    if args.costs and not args.billing_account:
+        print("Error: --billing-account required")
+        sys.exit(1)
+    
+    viewer = GCPBillingViewer(refresh_export_cache=args.refresh_export_cache, use_result_cache=not args.no_result_cache)
     
     if args.list_accounts:
         print("\n=== Billing Accounts ===\n")
-        viewer.format_output(viewer.list_billing_accounts(args.billing_account), args.format)
+        viewer.format_output(viewer.list_billing_accounts(args.billing_account, args.master_billing_account), args.format)
     
     if args.list_projects:
         print("\n=== Projects ===\n")
-        viewer.format_output(viewer.list_projects_with_billing(args.billing_account), args.format)
+        viewer.format_output(viewer.list_projects_with_billing(args.billing_account, args.master_billing_account), args.format)
     
     if args.costs:
-        if not args.billing_account:
-            print("Error: --billing-account required")
-            sys.exit(1)
-        
-        end = args.end_date or datetime.now().strftime('%Y-%m-%d')
-        start = args.start_date or (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+        end = args.end_date or date.today()
+        start = args.start_date or date.today() - timedelta(days=30)
         
-        costs = viewer.get_costs_from_bigquery(args.billing_account, start, end, args.project, args.group_by, args.debug)
+        costs, totals = viewer.get_costs_from_bigquery(args.billing_account, start, end, args.project, args.group_by, args.debug, args.max_bytes)
         viewer.format_output(costs, args.format)
         
-        if costs and args.format == 'table':
-            total = sum(c['cost'] for c in costs)
-            print(f"\nTotal: {total:.2f} {costs[0]['currency']}")
+        if totals and args.format in ('table', 'pretty'):
+            print()
+            for total in totals:
+                print(f"Total: {total['cost']:.2f} {total['currency']}")
 
 if __name__ == '__main__':
     main()
@@ -1,39 +1,120 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 import os
 import sys
 import warnings
+from datetime import datetime, timedelta, timezone
+from functools import cached_property
 from typing import Optional
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='google.api_core._python_version_support')
 
-try:
-    from google.cloud import billing_v1
-    from google.cloud import bigquery
-    from google.cloud import resourcemanager_v3
-    from google.auth import default
-    from google.auth.exceptions import DefaultCredentialsError, RefreshError
-    from google.api_core import exceptions
-except ImportError as e:
+def _exit_missing_dependency(e: ImportError):
     print(f"Error: Missing required dependency: {e}")
     print("\nPlease install dependencies with:")
     print("  uv pip install -r requirements.txt")
     sys.exit(1)
 
+# The Cloud Billing and BigQuery clients are imported and built when first used, so
+# --help and argument errors don't pay for loading them
+try:
+    from google.auth import default
+    from google.auth.exceptions import DefaultCredentialsError, RefreshError, TransportError
+    from google.api_core import exceptions
+except ImportError as e:
+    _exit_missing_dependency(e)
+
+ADC_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'gcp-bill-viewer', 'adc.json')
+# setup waits on the user in the Console, so only reuse tokens with plenty of life left
+ADC_CACHE_MIN_VALIDITY = timedelta(minutes=15)
+# Service-account and impersonated credentials can't be refreshed without scopes
+CLOUD_PLATFORM_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+# Backoff between export-table probes after the Console step, about a minute in total
+VERIFY_POLL_DELAYS = (1, 2, 4, 8, 16, 29)
+# Without a TTY the poll is also the wait for the Console step, so allow five minutes
+NONINTERACTIVE_POLL_DELAYS = (1, 2, 4, 8, 15) + (30,) * 9
+
+
+def _adc_file_mtime() -> Optional[float]:
+    """mtime of gcloud's application default credentials, to notice a re-login"""
+    config_dir = os.environ.get('CLOUDSDK_CONFIG') or os.path.join(os.path.expanduser('~'), '.config', 'gcloud')
+    try:
+        return os.path.getmtime(os.path.join(config_dir, 'application_default_credentials.json'))
+    except OSError:
+        return None
+
+
+def _load_cached_credentials():
+    """Return credentials from the token cache, or None if missing or near expiry"""
+    try:
+        with open(ADC_CACHE_PATH) as f:
+            entry = json.load(f)
+        expiry = datetime.strptime(entry['expiry'], '%Y-%m-%dT%H:%M:%S')
+    except (OSError, ValueError, KeyError):
+        return None
+    if entry.get('adc_mtime') != _adc_file_mtime() or expiry - datetime.now(timezone.utc).replace(tzinfo=None) < ADC_CACHE_MIN_VALIDITY:
+        return None
+    from google.oauth2.credentials import Credentials
+    return Credentials(token=entry['token'], expiry=expiry, quota_project_id=entry.get('quota_project_id'))
+
+
+def _save_cached_credentials(credentials):
+    if not credentials.token or not credentials.expiry:
+        return
+    entry = {
+        'token': credentials.token,
+        'expiry': credentials.expiry.strftime('%Y-%m-%dT%H:%M:%S'),
+        'quota_project_id': getattr(credentials, 'quota_project_id', None),
+        'adc_mtime': _adc_file_mtime(),
+    }
+    try:
+        os.makedirs(os.path.dirname(ADC_CACHE_PATH), exist_ok=True)
+        # The file holds a bearer token: create it readable by the owner only
+        fd = os.open(ADC_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        # The mode above only applies on creation; tighten a pre-existing file too
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+    except OSError:
+        pass
+
 
 class BigQueryExportSetup:
     def __init__(self):
         self.credentials = None
         self.default_project_id = None
         self._authenticate()
-        self.billing_client = billing_v1.CloudBillingClient(credentials=self.credentials)
         self.bq_client = None
+        self._bq_clients = {}
+
+    @cached_property
+    def billing_client(self):
+        try:
+            from google.cloud import billing_v1
+        except ImportError as e:
+            _exit_missing_dependency(e)
+        return billing_v1.CloudBillingClient(credentials=self.credentials)
+
+    def _get_bq_client(self, project_id: str):
+        """Return the BigQuery client for project_id, creating it on first use"""
+        if project_id not in self._bq_clients:
+            try:
+                from google.cloud import bigquery
+            except ImportError as e:
+                _exit_missing_dependency(e)
+            self._bq_clients[project_id] = bigquery.Client(credentials=self.credentials, project=project_id)
+        return self._bq_clients[project_id]
 
     def _authenticate(self):
         """
         Authenticate using user credentials instead of service account credentials.
         This temporarily unsets GOOGLE_APPLICATION_CREDENTIALS to prefer user credentials.
+        The project is resolved by default() on every run; only the access token is cached,
+        so a still-valid token from a previous run saves the refresh round trip.
         """
         # Store the original value
         original_creds = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
@@ -43,9 +124,18 @@ class BigQueryExportSetup:
             if 'GOOGLE_APPLICATION_CREDENTIALS' in os.environ:
                 del os.environ['GOOGLE_APPLICATION_CREDENTIALS']
             
-            self.credentials, self.default_project_id = default()
+            credentials, self.default_project_id = default(scopes=CLOUD_PLATFORM_SCOPES)
+            
+            cached = _load_cached_credentials()
+            if cached:
+                self.credentials = cached
+            else:
+                from google.auth.transport.requests import Request
+                credentials.refresh(Request())
+                _save_cached_credentials(credentials)
+                self.credentials = credentials
             
-        except (DefaultCredentialsError, RefreshError) as e:
+        except (DefaultCredentialsError, RefreshError, TransportError) as e:
             print("Error: Not authenticated with Google Cloud.")
             print(f"\nDetails: {e}")
             print("\nPlease authenticate using one of these methods:")
@@ -66,17 +156,24 @@ class BigQueryExportSetup:
         dataset_name: str = 'billing_export',
         location: str = 'US'
     ):
+        import time
+        import webbrowser
+        
+        console_url = f"https://console.cloud.google.com/billing/{billing_account_id}/export"
+        expected_table = f"gcp_billing_export_v1_{billing_account_id.replace('-', '_')}"
+        
         print(f"\n=== Setting up BigQuery Billing Export ===\n")
         print(f"Billing Account: {billing_account_id}")
         print(f"Project: {project_id}")
         print(f"Dataset: {dataset_name}")
         print(f"Location: {location}\n")
         
-        self.bq_client = bigquery.Client(credentials=self.credentials, project=project_id)
+        self.bq_client = self._get_bq_client(project_id)
         
         print("Step 1: Verifying project access...")
         try:
-            datasets = list(self.bq_client.list_datasets(max_results=1))
+            # One metadata GET proves the project exists and BigQuery is enabled and accessible
+            self.bq_client.get_service_account_email()
             print(f"  ‚úì Project '{project_id}' verified (BigQuery access confirmed)")
         except exceptions.NotFound:
             print(f"  ‚úó Project '{project_id}' not found")
@@ -93,23 +190,22 @@ class BigQueryExportSetup:
             sys.exit(1)
         
         print("\nStep 2: Creating BigQuery dataset...")
+        from google.cloud import bigquery
         dataset_id = f"{project_id}.{dataset_name}"
-        dataset = bigquery.Dataset(dataset_id)
-        dataset.location = location
         
         try:
-            dataset = self.bq_client.create_dataset(dataset, exists_ok=True)
-            print(f"  ‚úì Dataset '{dataset_name}' created/verified in {location}")
+            # Re-runs find the dataset with one GET; only a missing dataset is created
+            try:
+                dataset = self.bq_client.get_dataset(dataset_id)
+            except exceptions.NotFound:
+                dataset = bigquery.Dataset(dataset_id)
+                dataset.location = location
+                dataset = self.bq_client.create_dataset(dataset, exists_ok=True)
+            print(f"  ‚úì Dataset '{dataset_name}' created/verified in {dataset.location or location}")
+            if dataset.location and dataset.location.upper() != location.upper():
+                print(f"  ‚ö† Dataset already exists in {dataset.location}, not the requested {location}")
+                print(f"    Billing export will write to {dataset.location}; use --dataset to pick another dataset")
             print(f"    Full dataset ID: {dataset_id}")
-            
-            existing_tables = list(self.bq_client.list_tables(dataset_name))
-            if existing_tables:
-                print(f"    Existing tables in dataset: {len(existing_tables)}")
-                for table in existing_tables:
-                    print(f"      - {table.table_id}")
-            else:
-                print(f"    Dataset is empty (no tables yet - this is expected)")
-                
             print(f"    View dataset: https://console.cloud.google.com/bigquery?project={project_id}&ws=!1m4!1m3!3m2!1s{project_id}!2s{dataset_name}")
         except Exception as e:
             print(f"  ‚úó Error creating dataset: {e}")
@@ -121,38 +217,36 @@ class BigQueryExportSetup:
             sys.exit(1)
         
         print("\nStep 3: Configuring billing export...")
-        print("  ‚ö† IMPORTANT: Billing export MUST be configured via GCP Console")
-        print("  This is a Google Cloud Platform limitation - no API exists for this.")
-        print("")
-        print("=" * 70)
-        print("  REQUIRED MANUAL STEP - PLEASE COMPLETE NOW")
-        print("=" * 70)
-        print("")
-        print(f"  The dataset '{dataset_name}' has already been created for you!")
-        print(f"  Now you just need to link it to your billing account.")
-        print("")
-        print(f"  1. Open this URL in your browser:")
-        print(f"     https://console.cloud.google.com/billing/{billing_account_id}/export")
-        print("")
-        print(f"  2. Click the 'BIGQUERY EXPORT' tab")
-        print("")
-        print(f"  3. Under 'Detailed usage cost', click 'EDIT SETTINGS'")
-        print("")
-        print(f"  4. In the form that opens:")
-        print(f"     ‚Ä¢ Enable: Toggle to ON")
-        print(f"     ‚Ä¢ Project dropdown: Select '{project_id}'")
-        print(f"     ‚Ä¢ Dataset dropdown: Select '{dataset_name}' (already exists!)")
-        print("")
-        print(f"  5. Click 'SAVE'")
-        print("")
-        print(f"  NOTE: The dataset '{dataset_name}' already exists in your project.")
-        print(f"        You're just telling GCP to export billing data TO this dataset.")
-        print("")
-        print("=" * 70)
-        print("")
-        
-        import webbrowser
-        console_url = f"https://console.cloud.google.com/billing/{billing_account_id}/export"
+        sys.stdout.write(f"""  ‚ö† IMPORTANT: Billing export MUST be configured via GCP Console
+  This is a Google Cloud Platform limitation - no API exists for this.
+
+{'=' * 70}
+  REQUIRED MANUAL STEP - PLEASE COMPLETE NOW
+{'=' * 70}
+
+  The dataset '{dataset_name}' has already been created for you!
+  Now you just need to link it to your billing account.
+
+  1. Open this URL in your browser:
+     {console_url}
+
+  2. Click the 'BIGQUERY EXPORT' tab
+
+  3. Under 'Detailed usage cost', click 'EDIT SETTINGS'
+
+  4. In the form that opens:
+     ‚Ä¢ Enable: Toggle to ON
+     ‚Ä¢ Project dropdown: Select '{project_id}'
+     ‚Ä¢ Dataset dropdown: Select '{dataset_name}' (already exists!)
+
+  5. Click 'SAVE'
+
+  NOTE: The dataset '{dataset_name}' already exists in your project.
+        You're just telling GCP to export billing data TO this dataset.
+
+{'=' * 70}
+
+""")
         
         try:
             print(f"Attempting to open browser automatically...")
@@ -163,29 +257,36 @@ class BigQueryExportSetup:
             print(f"  Please manually open: {console_url}")
         
         print("")
-        try:
-            input("Press ENTER after you have completed the configuration in the Console...")
-            
-            print("\nVerifying configuration...")
-            import time
-            print("Waiting 10 seconds for GCP to create the export table...")
-            time.sleep(10)
-        except EOFError:
-            print("Running in non-interactive mode - skipping verification...")
-            print("You can verify the export later once you've configured it in the Console.")
-            import time
-        
-        clean_billing_id = billing_account_id.replace('-', '_')
-        expected_table = f"gcp_billing_export_v1_{clean_billing_id}"
+        poll_delays = ()
+        if sys.stdin.isatty():
+            try:
+                input("Press ENTER after you have completed the configuration in the Console...")
+                
+                print("\nVerifying configuration...")
+                print(f"Waiting up to {sum(VERIFY_POLL_DELAYS)} seconds for GCP to create the export table...")
+                poll_delays = VERIFY_POLL_DELAYS
+            except EOFError:
+                print("\nSkipping verification...")
+                print("You can verify the export later once you've configured it in the Console.")
+        else:
+            # Nobody can press ENTER: the export table appearing is the signal to continue
+            print("Running in non-interactive mode - watching for the export table...")
+            print(f"Waiting up to {sum(NONINTERACTIVE_POLL_DELAYS) // 60} minutes for GCP to create the export table...")
+            poll_delays = NONINTERACTIVE_POLL_DELAYS
         
         try:
-            tables = list(self.bq_client.list_tables(dataset_name))
             table_found = False
-            for table in tables:
-                if expected_table in table.table_id:
+            # Probe the exact table with backoff instead of sleeping a fixed time and listing
+            for delay in poll_delays + (None,):
+                try:
+                    self.bq_client.get_table(f"{dataset_id}.{expected_table}")
                     table_found = True
-                    print(f"‚úì Billing export table created: {table.table_id}")
+                    print(f"‚úì Billing export table created: {expected_table}")
                     break
+                except exceptions.NotFound:
+                    if delay is None:
+                        break
+                    time.sleep(delay)
             
             if not table_found:
                 print(f"‚ö† Table '{expected_table}' not found yet")
@@ -202,9 +303,9 @@ class BigQueryExportSetup:
         
         print(f"\n=== Setup Information ===\n")
         print(f"Dataset created: {dataset_id}")
-        print(f"Location: {location}")
+        print(f"Location: {dataset.location or location}")
         print(f"\nAfter configuring export in Console, billing data will appear in:")
-        print(f"  Table: {dataset_id}.gcp_billing_export_v1_{billing_account_id.replace('-', '_')}")
+        print(f"  Table: {dataset_id}.{expected_table}")
         print(f"\nData will be available ~24 hours after export is enabled.")
         print(f"\nTo verify export is working:")
         print(f"  python gcp-bill-viewer.py --costs --billing-account {billing_account_id}")
@@ -222,8 +323,6 @@ class BigQueryExportSetup:
         if not project_id:
             project_id = self.default_project_id
         
-        self.bq_client = bigquery.Client(credentials=self.credentials, project=project_id)
-        
         print("Step 1: Disabling billing export...")
         print("  ‚ö† Note: Billing export must be disabled via GCP Console")
         print("\n  Manual steps required:")
@@ -238,6 +337,8 @@ class BigQueryExportSetup:
             dataset_id = f"{project_id}.{dataset_name}"
             
             try:
+                # Only this branch talks to BigQuery; keeping the dataset needs no client
+                self.bq_client = self._get_bq_client(project_id)
                 self.bq_client.delete_dataset(
                     dataset_id,
                     delete_contents=True,
@@ -260,11 +361,7 @@ class BigQueryExportSetup:
             print(f"Dataset '{dataset_name}' has been deleted.")
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Setup or destroy BigQuery billing export for GCP',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog="""
+_EPILOG = """
 Examples:
   Setup billing export:
     %(prog)s --setup --billing-account 01234-ABCDEF-56789 --project my-billing-project
@@ -277,7 +374,14 @@ Examples:
   
   Destroy billing export (delete dataset):
     %(prog)s --destroy --billing-account 01234-ABCDEF-56789 --project my-billing-project --delete-dataset
-        """
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Setup or destroy BigQuery billing export for GCP',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=_EPILOG
     )
     
     action_group = parser.add_mutually_exclusive_group(required=True)